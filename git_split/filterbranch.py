@@ -12,8 +12,115 @@ import logging
 
 class FilterBranch:
 
-    tag_filter = '''cat'''
+    state_branch = '''refs/git-split/state'''
+    tag_refs = '''refs/git-split/tags/'''
     index_filter = '''git ls-files -z | grep -z -v %s | xargs -0 --no-run-if-empty git rm --cached'''
+    # same as index_filter, but done per top level entry of the source tree
+    # using the tree cache. Each entry is looked up by its object, its mode,
+    # its name and the xor of the ids of the include patterns that could
+    # match below it, so entries whose patterns are unchanged still hit when
+    # other parts of the include set change. On a miss the entry alone is filtered in a
+    # scratch index. The cache entry also keeps the 'rm' output so it can be
+    # replayed on a hit.
+    cached_index_filter = '''
+TREE_CACHE_MAP="%s"
+TREE_CACHE_OBJECTS="%s"
+CLONE_OBJECTS="%s"
+SPLIT_KEY_BASE=%d
+SPLIT_PREFIXES=(%s)
+SPLIT_IDS=(%s)
+
+# filter-branch evals this for every commit in the same shell, so the
+# keys computed for each entry name are kept across commits
+declare -A _split_keys
+_split_mktree="$(pwd)/../split-mktree"
+_split_index="$(pwd)/../split-index"
+_split_hits=()
+: > "${_split_mktree}"
+
+while IFS= read -r -d '' _split_line
+do
+    _split_info="${_split_line%%%%	*}"
+    _split_name="${_split_line#*	}"
+    read -r _split_mode _split_type _split_sha <<< "${_split_info}"
+
+    _split_key="${_split_keys[${_split_name}]}"
+    if [ -z "${_split_key}" ]
+    then
+        _split_key=${SPLIT_KEY_BASE}
+        for _split_i in "${!SPLIT_PREFIXES[@]}"
+        do
+            case "${_split_name}/" in
+            "${SPLIT_PREFIXES[$_split_i]}"*)
+                _split_key=$(( _split_key ^ SPLIT_IDS[_split_i] ))
+                continue
+                ;;
+            esac
+            case "${SPLIT_PREFIXES[$_split_i]}" in
+            "${_split_name}/"*)
+                _split_key=$(( _split_key ^ SPLIT_IDS[_split_i] ))
+                ;;
+            esac
+        done
+        _split_keys[${_split_name}]=${_split_key}
+    fi
+
+    # the mode is part of the entry so a blob that only changed its mode,
+    # or became a symlink, is never replayed with the mode of another commit
+    _split_entry="${TREE_CACHE_MAP}/${_split_key}/${_split_sha:0:2}/${_split_sha:2}/${_split_mode}/${_split_name}"
+    if [ -f "${_split_entry}" ] && read -r _split_result < "${_split_entry}"
+    then
+        _split_hits+=("${_split_entry}")
+    else
+        # first line is the filtered entry or "-" when nothing is left,
+        # followed by the 'rm' output
+        _split_out=$(
+            export GIT_INDEX_FILE="${_split_index}"
+            export GIT_OBJECT_DIRECTORY="${TREE_CACHE_OBJECTS}"
+            export GIT_ALTERNATE_OBJECT_DIRECTORIES="${CLONE_OBJECTS}"
+            rm -f "${GIT_INDEX_FILE}"
+            if [ "${_split_type}" = tree ]
+            then
+                git read-tree --prefix="${_split_name}/" "${_split_sha}" || exit 1
+            else
+                git update-index --add --cacheinfo "${_split_mode},${_split_sha},${_split_name}" || exit 1
+            fi
+            _split_removed=$(git ls-files -z | grep -z -v %s | xargs -0 --no-run-if-empty git rm --cached) ||
+                exit 1
+            _split_root=$(git write-tree) || exit 1
+            if [ "${_split_root}" = 4b825dc642cb6eb9a060e54bf8d69288fbee4904 ]
+            then
+                echo "-"
+            elif [ "${_split_type}" = tree ]
+            then
+                _split_sub=$(git rev-parse "${_split_root}:${_split_name}") || exit 1
+                echo "040000 tree ${_split_sub}"
+            else
+                echo "${_split_info}"
+            fi
+            [ -z "${_split_removed}" ] || echo "${_split_removed}"
+        ) || die "could not filter ${_split_name} for $GIT_COMMIT"
+
+        _split_result="${_split_out%%%%$'\\n'*}"
+        [ "${_split_out}" = "${_split_result}" ] || echo "${_split_out#*$'\\n'}"
+        mkdir -p "${_split_entry%%/*}" &&
+        printf '%%s\\n' "${_split_out}" > "${_split_entry}.$$" &&
+        mv -f "${_split_entry}.$$" "${_split_entry}" ||
+        rm -f "${_split_entry}.$$"
+    fi
+
+    [ "${_split_result}" = "-" ] || printf '%%s\\t%%s\\0' "${_split_result}" "${_split_name}" >> "${_split_mktree}"
+done < <(git ls-tree -z "$GIT_COMMIT^{tree}")
+
+if [ "${#_split_hits[@]}" -gt 0 ]
+then
+    touch "${_split_hits[@]}"
+    tail -q -n +2 "${_split_hits[@]}"
+fi
+
+_split_tree=$(git mktree -z < "${_split_mktree}") &&
+git read-tree "${_split_tree}"
+'''
     commit_filter = '''
 
 DEBUG_LVL=%d
@@ -99,11 +206,7 @@ else
         my_tree="$1"
         shift
 
-        tmpd="/tmp/cj-git-filter-branch.$$"
-        (
-            umask 0077
-            mkdir "$tmpd"
-        )
+        declare -A seenparents=()
         declare -a allparents=()
         for p in "$@"
         do
@@ -111,14 +214,13 @@ else
             if [ ! x"$p" = x"-p" ]
             then
                 # eliminate parent doubles
-                if [ ! -e "$tmpd/$p" ]
+                if [ -z "${seenparents[$p]}" ]
                 then
-                    touch "$tmpd/$p"
+                    seenparents[$p]=1
                     allparents+=("$p")
                 fi
             fi
         done
-        rm -rf "$tmpd"
 
         declare -a sametreeparents=()
         declare -a notsametreeparents=()
@@ -12,6 +12,11 @@ from threading import Thread
 import git
 
 from git_split import filterbranch
+from git_split import progress
+from git_split import scratch
+from git_split import spill
+from git_split import tags
+from git_split import treecache
 
 try:
     from Queue import Queue, Empty
@@ -86,7 +91,8 @@ def shortest_exclusive_paths(excludes, includes):
 
 
 def git_output_process(
-        removed_files_list, proc, logger=None, ignore_removed=False):
+        removed_files_list, proc, logger=None, ignore_removed=False, state_memory=64 * 1024 * 1024,
+        job=None, spill_dir=None):
 
     def enqueue_output(out, queue):
         for line in iter(out.readline, b''):
@@ -105,14 +111,16 @@ def git_output_process(
 
     commit_regex = re.compile("^Rewrite [a-z0-9]{40} \((([^\/]*)\/([^\)]*))\)")
     files_removed_regex = re.compile(".*rm '([^']*)'$")
-    print("Processing commit:", end="")
 
     if not logger:
         logger = logging.getLogger()
 
-    string_len = 0
-    files_removed = []
-    while proc.poll() is None:
+    stdout_line = stderr_line = ""
+    commits_done = 0
+    files_removed = spill.SpillSet(state_memory, spill_dir)
+    # keep going until the output of the finished process has been consumed
+    while (proc.poll() is None or tstdout.is_alive() or tstderr.is_alive() or
+           not qstdout.empty() or not qstderr.empty()):
         # stdout
         try:
             stdout_line = qstdout.get_nowait()
@@ -122,17 +130,19 @@ def git_output_process(
 
             stdout_line = stdout_line.decode("utf-8").strip()
             logger.debug(stdout_line)
-            matches = commit_regex.match(stdout_line)
-            if matches:
-                print("\b" * string_len, end="")
-                print(matches.group(1), end="")
-                string_len = len(matches.group(1)) + 2
+            if job:
+                # filter-branch writes a '\r' separated update per commit, but
+                # only refreshes the count in them about once a second
+                for segment in stdout_line.split("\r"):
+                    matches = commit_regex.match(segment)
+                    if matches:
+                        commits_done += 1
+                        job.update(commits_done, int(matches.group(3)))
 
             if not ignore_removed:
                 matches = files_removed_regex.match(stdout_line)
                 if matches:
-                    if matches.group(1) not in files_removed:
-                        files_removed.append(matches.group(1))
+                    files_removed.add(matches.group(1))
 
         # stderr
         try:
@@ -144,22 +154,30 @@ def git_output_process(
             logger.info(stderr_line)
 
     # finished
-    print()
+    if job:
+        job.finish()
 
     if not ignore_removed:
-        # store list of files removed for main loop to examine
+        # store set of files removed for main loop to examine
+        if files_removed.spilled:
+            logger.info("Removed files exceeded memory limit, spilled to disk")
         removed_files_list.append(files_removed)
 
     return(proc.returncode, stdout_line, stderr_line)
 
 
 def split_repo(src_repo, include_file, include_pattern, authors_file, new_repo, branches, prune,
-               keep_branches, removed_files, ignore_removed):
+               keep_branches, removed_files, ignore_removed, tree_cache_dir=None, tree_cache_size=0,
+               state_memory=64 * 1024 * 1024, empty_tags='drop', scratch_dir=None,
+               scratch_limit=2048 * 1024 * 1024, reporter=None):
+
+    # share the terminal with the other splits through the reporter
+    output = reporter.message if reporter else print
 
     includes = []
     if include_file is not None:
         if not os.path.exists(include_file):
-            print("Specified include file does not exist: %s" % include_file)
+            output("Specified include file does not exist: %s" % include_file)
             sys.exit(1)
         includes = [line.strip()
                     for line in open(include_file, 'r').read().split('\n')
@@ -171,13 +189,13 @@ def split_repo(src_repo, include_file, include_pattern, authors_file, new_repo,
                          if pattern])
 
     if includes == []:
-        print("No include pattern specified! Cannot prune repo!")
+        output("No include pattern specified! Cannot prune repo!")
         return False
 
     # sort out logging
     logname = os.path.basename(new_repo.rstrip(os.path.sep))
     logfile = "%s.log" % logname
-    print("Using logfile: %s" % logfile)
+    output("Using logfile: %s" % logfile)
     logger = logging.getLogger(logname)
     rh = handlers.RotatingFileHandler(logfile, backupCount=10)
     rh.setFormatter(logging.Formatter("%(message)s"))
@@ -187,7 +205,7 @@ def split_repo(src_repo, include_file, include_pattern, authors_file, new_repo,
     if os.path.isfile(logfile) and os.path.getsize(logfile) > 0:
         rh.doRollover()
 
-    print("Cloning local repo to new path")
+    output("Cloning local repo to new path")
     local_clone = git.Repo(src_repo)
     remote_ref = local_clone.git.config("--get", "remote.origin.url", with_exceptions=False)
     if remote_ref:
@@ -214,45 +232,95 @@ def split_repo(src_repo, include_file, include_pattern, authors_file, new_repo,
     new_clone.git.remote("rm", "origin")
 
     if branches is None or branches == []:
-        branches = ["--", "--all"]
-
-    print("Pruning branches \"%s\" of everything except the following paths:" % ", ".join(branches))
-    print("\n".join(includes))
-    print()
+        # walk the history of every tag, but leave the tags to rewrite_tags
+        tags.prepare_tags(new_clone, filterbranch.FilterBranch.tag_refs)
+        branches = ["--", "--branches", "--glob=%s*" % filterbranch.FilterBranch.tag_refs]
+
+    output("Pruning branches \"%s\" of everything except the following paths:" % ", ".join(branches))
+    output("\n".join(includes))
+    output("")
+
+    include_args = ' '.join(['''-e \"^%s\"''' % p for p in includes])
+    index_filter = filterbranch.FilterBranch.index_filter % include_args
+
+    tree_cache = None
+    if tree_cache_size > 0:
+        if tree_cache_dir is None:
+            tree_cache_dir = os.path.join(local_clone.git_dir, "git-split", "tree-cache")
+        tree_cache = treecache.TreeCache(tree_cache_dir, tree_cache_size,
+                                         os.path.join(local_clone.git_dir, "objects"), logger)
+        output("Using tree cache: %s" % tree_cache.path)
+        tree_cache.open()
+        tree_cache.attach(new_clone)
+        index_filter = tree_cache.index_filter(
+            filterbranch.FilterBranch.cached_index_filter, includes,
+            os.path.abspath(os.path.join(new_clone.git_dir, "objects")), include_args)
+
+    scratch_space = scratch.Scratch(scratch_dir or new_clone.git_dir, logname, scratch_limit)
+    output("Using scratch space: %s" % scratch_space.path)
+
+    # filter-branch commits the state branch as the caller, which is
+    # deleted again once tags are rewritten so any identity will do
+    env = {"GIT_AUTHOR_NAME": "git-split", "GIT_AUTHOR_EMAIL": "git-split@localhost",
+           "GIT_COMMITTER_NAME": "git-split", "GIT_COMMITTER_EMAIL": "git-split@localhost"}
+    env.update(scratch_space.env(new_clone))
 
     debug_lvl = 3
+    proc = new_clone.git.filter_branch(
+        "--index-filter", index_filter,
+        "--commit-filter", filterbranch.FilterBranch.commit_filter % (debug_lvl, authors_file or ""),
+        "--state-branch", filterbranch.FilterBranch.state_branch,
+        "-d", scratch_space.rewrite_dir,
+        "-f",
+        *branches,
+        as_process=True,
+        env=env,
+    )
+    scratch_space.monitor(proc, logger)
     (status, last_output, last_error) = git_output_process(
         removed_files,
-        new_clone.git.filter_branch(
-            "--index-filter", filterbranch.FilterBranch.index_filter % ' '.join(['''-e \"^%s\"''' % p for p in includes]),
-            "--commit-filter", filterbranch.FilterBranch.commit_filter % (debug_lvl, authors_file or ""),
-            "--tag-name-filter", filterbranch.FilterBranch.tag_filter,
-            "-f",
-            *branches,
-            as_process=True,
-        ),
+        proc,
         logger,
-        ignore_removed
+        ignore_removed,
+        state_memory,
+        reporter.job(logname) if reporter else None,
+        # on disk, as the default temp dir may be a tmpfs
+        new_clone.git_dir
     )
 
     if status != 0:
         logger.error("filter-branch failed")
         logger.info("last output: %s\nlast error: %s" % (last_output, last_error))
-        print("Critical Failure")
+        scratch_space.cleanup()
+        if tree_cache:
+            tree_cache.close()
+        output("Critical Failure")
         sys.exit(1)
 
+    scratch_space.pack_objects(new_clone)
+    scratch_space.cleanup()
+
     # clean up
-    print("Removing refs/original/*")
-    for ref in new_clone.git.for_each_ref("--format=%(refname)", "refs/original/").split():
-        logger.info("Deleteing %s" % ref)
-        new_clone.git.update_ref("-d", ref)
+    output("Rewriting tags and removing refs/original/*")
+    try:
+        tags.rewrite_tags(new_clone, filterbranch.FilterBranch.state_branch,
+                          filterbranch.FilterBranch.tag_refs, empty_tags, logger)
+    except tags.EmptyTagError as e:
+        logger.error(str(e))
+        if tree_cache:
+            tree_cache.close()
+        output("Critical Failure: %s" % e)
+        sys.exit(1)
 
     new_clone.git.reflog("expire", "--expire=now", "--all")
+    if tree_cache:
+        tree_cache.detach(new_clone)
+        tree_cache.close()
     new_clone.git.gc(aggressive=True, prune="now")
 
     # prune branches that point to the same ref
     if keep_branches != []:
-        print("Pruning duplicate branches")
+        output("Pruning duplicate branches")
         logger.info("Keeping branches %s" % keep_branches)
         for branch in keep_branches:
             new_clone.git.checkout(branch)
@@ -317,6 +385,32 @@ including merge commits, pruned and placed under a new repository.
                            'standard text file with each line in the format: '
                            '"old-name:new-email[:new-name:new-email]". Where '
                            '[...] denotes optional fields')
+    parser.add_option('--tree-cache-dir', dest='tree_cache_dir',
+                      help='Directory holding the filtered tree cache shared between runs '
+                           'and splits. Default is "git-split/tree-cache" under the git '
+                           'directory of the source repository.')
+    parser.add_option('--tree-cache-size', dest='tree_cache_size', type='int', default=1024,
+                      help='Maximum size in MiB of the filtered tree cache, least recently '
+                           'used entries are evicted once exceeded. Set to 0 to disable '
+                           'the cache. Default is %default.')
+    parser.add_option('--state-memory', dest='state_memory', type='int', default=64,
+                      help='Memory ceiling in MiB for the state tracked by each split, such '
+                           'as the removed files. State beyond this is spilled to a temporary '
+                           'database in the git directory of the target repository. Default is '
+                           '%default.')
+    parser.add_option('--empty-tags', dest='empty_tags', type='choice', choices=tags.EMPTY_TAG_POLICIES,
+                      default='drop',
+                      help='What to do with tags whose history became empty after the split: '
+                           '"drop" deletes them, "keep" moves them onto an empty commit with the '
+                           'original message and "fail" aborts the split. Default is %default.')
+    parser.add_option('--scratch-dir', dest='scratch_dir',
+                      help='Directory under which each split keeps its temporary index, '
+                           'map files and newly written objects while rewriting. Default '
+                           'is %s when it has room for --scratch-limit for every split run at '
+                           'once, otherwise the git directory of each target repository.' % scratch.TMPFS)
+    parser.add_option('--scratch-limit', dest='scratch_limit', type='int', default=2048,
+                      help='Maximum size in MiB of the scratch space used by each split, '
+                           'the split is aborted once exceeded. Default is %default.')
 
     (options, args) = parser.parse_args(argv)
 
@@ -365,8 +459,25 @@ including merge commits, pruned and placed under a new repository.
         else:
             parser.error("Non-existant authors file given '%s', please specify a valid file for option '-a'")
 
+    tree_cache_dir = None
+    if options.tree_cache_dir:
+        tree_cache_dir = os.path.abspath(options.tree_cache_dir)
+
+    workers = min(len(options.include_files), 6)
+
+    if options.scratch_dir:
+        scratch_dir = os.path.abspath(options.scratch_dir)
+        if not os.path.isdir(scratch_dir):
+            parser.error("Scratch directory does not exist: '%s'" % options.scratch_dir)
+    else:
+        # reserve room for every split that may be running at the same time
+        scratch_dir = scratch.Scratch.default_base(options.scratch_limit * 1024 * 1024, workers)
+
+    reporter = progress.Progress()
+    reporter.start()
+
     removed_files = []
-    pool = ThreadPool(min(len(options.include_files), 6))
+    pool = ThreadPool(workers)
     for include_file in options.include_files:
         if not os.path.exists(include_file):
             parser.error("Specified include file does not exist: '%s'. Use a valid file with -i" % include_file)
@@ -385,21 +496,30 @@ including merge commits, pruned and placed under a new repository.
 
         if os.path.exists(new_repo):
             if options.force:
-                print("Existing copy found, removing to start from fresh")
+                reporter.message("Existing copy found, removing to start from fresh")
                 shutil.rmtree(new_repo)
             else:
                 parser.error("Target repository path (%s) already exists, cannot create" % new_repo)
 
         pool.add_task(split_repo, src_repo, include_file, options.file_pattern, authors, new_repo,
-                      options.branches, options.prune, keep_branches, removed_files, options.ignore_removed)
+                      options.branches, options.prune, keep_branches, removed_files, options.ignore_removed,
+                      tree_cache_dir, options.tree_cache_size * 1024 * 1024,
+                      options.state_memory * 1024 * 1024, options.empty_tags, scratch_dir,
+                      options.scratch_limit * 1024 * 1024, reporter)
 
     # finished
     pool.wait_completion()
+    reporter.stop()
 
     if not options.ignore_removed and removed_files:
-        # look to see if we included all files and directories in one of the splits
-        list_sets = [set(list) for list in removed_files]
-        removed_files = set.intersection(*list_sets)
+        # look to see if we included all files and directories in one of the splits,
+        # walking the smallest set and probing the others to avoid copying them
+        removed_files.sort(key=len)
+        smallest, others = removed_files[0], removed_files[1:]
+        missed_files = [file for file in smallest
+                        if all(file in other for other in others)]
+        for files_removed in removed_files:
+            files_removed.close()
 
         includes = []
         for include_file in options.include_files:
@@ -414,7 +534,7 @@ including merge commits, pruned and placed under a new repository.
         # get the unique includes
         includes = set(includes)
 
-        ignored_files = shortest_exclusive_paths(removed_files, includes)
+        ignored_files = shortest_exclusive_paths(missed_files, includes)
         ignored_files.sort()
         if ignored_files != []:
             print("WARNING: after the split some files in the history were not included in any of the new split repos!")
@@ -0,0 +1,170 @@
+# progress
+#
+# module to report the progress of all running splits from a single thread,
+# so that several splits can share the terminal without garbling it and
+# without a terminal write for every rewritten commit.
+#
+# Copyright 2020 Hewlett Packard Enterprise Development LP
+#
+
+import sys
+import time
+from threading import Thread
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Job:
+    """Handle used by a split to send its progress to the reporter
+
+    Updates are sent at most once per reporter interval, as the reporter
+    can't draw them any faster, and finish() sends the latest counts.
+    """
+    def __init__(self, progress, name):
+        self.progress = progress
+        self.name = name
+        self.done = 0
+        self.total = 0
+        self.sent = None
+
+    def update(self, done, total):
+        self.done, self.total = done, total
+        now = time.time()
+        if self.sent is None or now - self.sent >= self.progress.interval:
+            self.sent = now
+            self.progress.events.put(("update", self.name, (done, total, now)))
+
+    def finish(self):
+        self.progress.events.put(("finish", self.name, (self.done, self.total, time.time())))
+
+
+class JobState:
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.start_done = 0
+        self.updated = None
+        self.done = 0
+        self.total = 0
+        self.finished = False
+
+    def rate(self):
+        if self.start is None or self.updated <= self.start:
+            return 0.0
+        return (self.done - self.start_done) / (self.updated - self.start)
+
+    def eta(self):
+        rate = self.rate()
+        if self.finished:
+            return 0
+        if rate <= 0:
+            return None
+        return (self.total - self.done) / rate
+
+    def status(self):
+        state = "done" if self.finished else "ETA %s" % format_eta(self.eta())
+        return "%s: %d/%d commits, %.1f commits/s, %s" % (
+            self.name, self.done, self.total, self.rate(), state)
+
+
+class Progress(Thread):
+    """Thread drawing the progress of every job at a fixed rate
+
+    On a terminal all jobs are redrawn in place, one line each, every
+    interval seconds. Otherwise, such as when logging to a file in CI, a
+    single line with the status of every started job is printed every
+    non_tty_interval seconds, as long as any of them changed. Messages sent
+    through message() are printed by the same thread so they don't
+    interleave with the display.
+    """
+
+    interval = 0.5
+    non_tty_interval = 30
+
+    def __init__(self, stream=None):
+        Thread.__init__(self)
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.events = Queue()
+        self.jobs = {}
+        self.drawn = 0
+        self.changed = False
+        self.daemon = True
+
+    def job(self, name):
+        self.events.put(("add", name, None))
+        return Job(self, name)
+
+    def message(self, text=""):
+        self.events.put(("message", None, text))
+
+    def stop(self):
+        self.events.put(("stop", None, None))
+        self.join()
+
+    def handle(self, event, name, data):
+        if event == "add":
+            self.jobs[name] = JobState(name)
+        elif event in ("update", "finish"):
+            job = self.jobs[name]
+            job.done, job.total, job.updated = data
+            if job.start is None:
+                job.start, job.start_done = job.updated, job.done
+            job.finished = event == "finish"
+            self.changed = True
+        elif event == "message":
+            self.clear()
+            self.stream.write("%s\n" % data)
+
+    def clear(self):
+        if self.tty and self.drawn:
+            self.stream.write("\x1b[%dA\x1b[J" % self.drawn)
+            self.drawn = 0
+
+    def draw(self):
+        jobs = [job for job in self.jobs.values() if job.start is not None]
+        if self.tty:
+            self.clear()
+            for job in jobs:
+                self.stream.write("%s\n" % job.status())
+            self.drawn = len(jobs)
+        elif self.changed and jobs:
+            self.stream.write("%s\n" % " | ".join(job.status() for job in jobs))
+        self.changed = False
+        self.stream.flush()
+
+    def run(self):
+        interval = self.interval if self.tty else self.non_tty_interval
+        next_draw = time.time() + interval
+        while True:
+            try:
+                event, name, data = self.events.get(timeout=max(next_draw - time.time(), 0))
+            except Empty:
+                event = None
+
+            if event == "stop":
+                self.draw()
+                return
+
+            if event is not None:
+                self.handle(event, name, data)
+                if event == "message":
+                    if self.tty:
+                        self.draw()
+                    else:
+                        self.stream.flush()
+
+            # a steady stream of events must not hold off drawing
+            if time.time() >= next_draw:
+                self.draw()
+                next_draw = time.time() + interval
@@ -0,0 +1,117 @@
+# scratch
+#
+# module to manage the scratch workspace used by filter-branch for its
+# temporary index, map files and the loose objects written while rewriting,
+# ideally on a RAM backed filesystem rather than next to the target repo.
+#
+# Copyright 2020 Hewlett Packard Enterprise Development LP
+#
+
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from threading import Thread
+
+TMPFS = "/dev/shm"
+
+
+def disk_usage(*paths):
+    """Return the space in bytes allocated to all files below the given paths
+
+    Counts allocated blocks rather than file sizes, as tmpfs uses at least a
+    page for every file and the rewrite writes many small ones.
+    """
+    size = 0
+    for top in paths:
+        for root, _, files in os.walk(top):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass
+    return size
+
+
+class Scratch:
+    """Per split scratch directory holding all temporary rewrite state
+
+    'rewrite' is given to filter-branch with -d in place of the target's
+    .git-rewrite, and 'objects' is used as the object directory while the
+    rewrite runs, with the target's own objects as an alternate, so the
+    loose objects written for every commit never touch the target. They are
+    packed into the target in one go by pack_objects once the rewrite ends.
+    """
+
+    check_interval = 10
+
+    def __init__(self, base, name, limit):
+        self.limit = limit
+        self.path = tempfile.mkdtemp(prefix="git-split-%s-" % name, dir=base)
+        self.rewrite_dir = os.path.join(self.path, 'rewrite')
+        self.objects = os.path.join(self.path, 'objects')
+        os.mkdir(self.objects)
+
+    @staticmethod
+    def default_base(limit, splits=1):
+        """Return the tmpfs mount if it has room for splits * limit bytes, else None"""
+        if os.path.isdir(TMPFS) and shutil.disk_usage(TMPFS).free >= limit * splits:
+            return TMPFS
+        return None
+
+    def usage(self):
+        return disk_usage(self.path)
+
+    def over_limit(self):
+        return self.usage() > self.limit
+
+    def monitor(self, proc, logger=None):
+        """Terminate proc from a background thread if the limit is exceeded
+
+        Walking the scratch space can take a while once the rewrite has
+        written many objects, so it is kept off the thread draining the
+        output of proc.
+        """
+        if not logger:
+            logger = logging.getLogger()
+
+        def check():
+            while proc.poll() is None:
+                time.sleep(self.check_interval)
+                if proc.poll() is None and self.over_limit():
+                    logger.error("Scratch space %s exceeded limit of %d bytes" % (self.path, self.limit))
+                    proc.terminate()
+                    return
+
+        thread = Thread(target=check)
+        thread.daemon = True  # thread dies with the program
+        thread.start()
+
+    def env(self, repo):
+        return {
+            "GIT_OBJECT_DIRECTORY": self.objects,
+            "GIT_ALTERNATE_OBJECT_DIRECTORIES": os.path.abspath(os.path.join(repo.git_dir, 'objects')),
+        }
+
+    def pack_objects(self, repo):
+        """Move the objects written during the rewrite into a pack in repo"""
+        loose = []
+        for name in os.listdir(self.objects):
+            if re.match("^[0-9a-f]{2}$", name):
+                loose.extend(name + obj for obj in os.listdir(os.path.join(self.objects, name)))
+        if not loose:
+            return
+
+        # borrow the scratch objects rather than using them as the object
+        # directory, pack-objects can't rename its output across filesystems
+        with tempfile.TemporaryFile(dir=self.path) as objects:
+            objects.write("".join("%s\n" % obj for obj in loose).encode("utf-8"))
+            objects.seek(0)
+            repo.git.pack_objects(
+                "-q", os.path.abspath(os.path.join(repo.git_dir, 'objects', 'pack', 'pack')),
+                istream=objects, env={"GIT_ALTERNATE_OBJECT_DIRECTORIES": self.objects})
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
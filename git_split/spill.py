@@ -0,0 +1,103 @@
+# spill
+#
+# module providing a set of paths with a bounded memory footprint, used to
+# keep track of the files removed during a split. Very long histories can
+# remove millions of distinct paths, and with several splits running at the
+# same time holding them all as python strings is not an option.
+#
+# Copyright 2020 Hewlett Packard Enterprise Development LP
+#
+
+import os
+import sqlite3
+import sys
+import tempfile
+
+
+class SpillSet:
+    """Set of strings that moves to a sqlite database once it outgrows memory_limit
+
+    Items are kept in a python set until its estimated size goes over
+    memory_limit bytes, after which they are moved to a temporary sqlite
+    database stored as utf-8 blobs. The sqlite page cache is bounded by the
+    same limit so memory use stays flat however many items are added.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, memory_limit, directory=None):
+        self.memory_limit = memory_limit
+        self.directory = directory
+        self._items = set()
+        self._size = 0
+        self._pending = []
+        self._db = None
+        self._path = None
+
+    @property
+    def spilled(self):
+        return self._db is not None
+
+    def _spill(self):
+        fd, self._path = tempfile.mkstemp(prefix="git-split-", suffix=".sqlite", dir=self.directory)
+        os.close(fd)
+        # the set is created by one worker thread and read by the main thread
+        # once the split has finished, never concurrently
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("PRAGMA cache_size = -%d" % max(self.memory_limit // 1024, 1024))
+        self._db.execute("CREATE TABLE items (item BLOB PRIMARY KEY) WITHOUT ROWID")
+        self._pending = list(self._items)
+        self._items = set()
+        self._size = 0
+        self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        self._db.executemany("INSERT OR IGNORE INTO items VALUES (?)",
+                             ((item.encode("utf-8"),) for item in self._pending))
+        self._db.commit()
+        self._pending = []
+
+    def add(self, item):
+        if self._db is not None:
+            self._pending.append(item)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            return
+
+        if item not in self._items:
+            self._items.add(item)
+            self._size += sys.getsizeof(item)
+            if self._size + sys.getsizeof(self._items) > self.memory_limit:
+                self._spill()
+
+    def __contains__(self, item):
+        if self._db is None:
+            return item in self._items
+        self._flush()
+        cursor = self._db.execute("SELECT 1 FROM items WHERE item = ?", (item.encode("utf-8"),))
+        return cursor.fetchone() is not None
+
+    def __iter__(self):
+        if self._db is None:
+            return iter(list(self._items))
+        self._flush()
+        return (item.decode("utf-8") for (item,) in self._db.execute("SELECT item FROM items"))
+
+    def __len__(self):
+        if self._db is None:
+            return len(self._items)
+        self._flush()
+        return self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def close(self):
+        """Release the memory or database file backing the set"""
+        self._items = set()
+        self._pending = []
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.unlink(self._path)
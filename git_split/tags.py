@@ -0,0 +1,216 @@
+# tags
+#
+# module to rewrite the tags of a split repository in a single batch once
+# filter-branch has finished, using the commit map filter-branch saved to
+# its state branch instead of letting it rewrite tags one at a time.
+#
+# Copyright 2020 Hewlett Packard Enterprise Development LP
+#
+
+import logging
+import re
+import tempfile
+
+from gitdb.util import hex_to_bin
+
+EMPTY_TAG_POLICIES = ('drop', 'keep', 'fail')
+
+signature_regex = re.compile(b"^-----BEGIN (PGP|SSH) SIGNATURE-----$", re.MULTILINE)
+
+
+class EmptyTagError(Exception):
+    """Raised when a tag lost all of its history and the policy is 'fail'"""
+
+
+def read_commit_map(repo, state_branch, commits):
+    """Return the rewritten commit for each of the given commits
+
+    Streams the 'old:new' map filter-branch stored in the state branch and
+    only keeps the entries asked for. A commit whose history became empty
+    maps to an empty string, one that was not walked is left out.
+    """
+    commit_map = {}
+    proc = repo.git.cat_file("blob", "%s:filter.map" % state_branch, as_process=True)
+    for line in proc.stdout:
+        old, _, new = line.decode("utf-8").strip().partition(":")
+        if old in commits:
+            commit_map[old] = new
+    proc.wait()
+    return commit_map
+
+
+def list_tags(repo):
+    """Return (ref, tag object or None, commit) for every tag of a commit
+
+    Tags of other tags are peeled down to the commit at the end of the
+    chain, so they are moved onto the rewritten history like any other.
+    """
+    tags = []
+    nested = []
+    output = repo.git.for_each_ref(
+        "--format=%(refname) %(objecttype) %(objectname) %(*objecttype) %(*objectname)",
+        "refs/tags/")
+    for line in output.splitlines():
+        fields = line.split()
+        if fields[1] == "commit":
+            tags.append((fields[0], None, fields[2]))
+        elif fields[1] == "tag" and len(fields) == 5 and fields[3] == "commit":
+            tags.append((fields[0], fields[2], fields[4]))
+        elif fields[1] == "tag" and len(fields) == 5 and fields[3] == "tag":
+            nested.append((fields[0], fields[2]))
+
+    if nested:
+        with tempfile.TemporaryFile() as stream:
+            stream.write("".join("%s^{}\n" % tag for _, tag in nested).encode("utf-8"))
+            stream.seek(0)
+            output = repo.git.cat_file("--batch-check=%(objectname) %(objecttype)", istream=stream)
+        for (ref, tag), line in zip(nested, output.splitlines()):
+            fields = line.split()
+            if fields[-1] == "commit":
+                tags.append((ref, tag, fields[0]))
+    return tags
+
+
+def update_refs(repo, ref_updates):
+    """Apply a list of update-ref --stdin commands in one transaction"""
+    with tempfile.TemporaryFile() as stream:
+        stream.write("".join("%s\n" % update for update in ref_updates).encode("utf-8"))
+        stream.seek(0)
+        repo.git.update_ref("--stdin", istream=stream)
+
+
+def prepare_tags(repo, tag_refs):
+    """Point a ref under tag_refs at every tagged commit the branches miss
+
+    filter-branch then walks all tagged history without being given the
+    tags themselves, leaving refs/tags alone for rewrite_tags, as it cannot
+    delete annotated tags whose history became empty. Tags on commits that
+    are reachable from a branch are rewritten from the commit map, so only
+    one ref per distinct unreachable commit is needed, which keeps the
+    per-ref work filter-branch does at the end small.
+    """
+    commits = set(commit for _, _, commit in list_tags(repo))
+    if not commits:
+        return
+
+    unreachable = set()
+    with tempfile.TemporaryFile() as stream:
+        stream.write("".join("%s\n" % commit for commit in commits).encode("utf-8"))
+        stream.seek(0)
+        # --stdin comes first so the tagged commits are not negated
+        proc = repo.git.rev_list("--stdin", "--not", "--branches", istream=stream, as_process=True)
+        for line in proc.stdout:
+            commit = line.decode("utf-8").strip()
+            if commit in commits:
+                unreachable.add(commit)
+        proc.wait()
+
+    if unreachable:
+        update_refs(repo, ["create %s%s %s" % (tag_refs, commit, commit) for commit in sorted(unreachable)])
+
+
+def tag_stream(repo, tag, name, commit):
+    """Return the fast-import commands recreating an annotated tag on commit"""
+    raw = repo.odb.stream(hex_to_bin(tag)).read()
+    headers, _, message = raw.partition(b"\n\n")
+
+    # the signature no longer matches the rewritten tag
+    signature = signature_regex.search(message)
+    if signature:
+        message = message[:signature.start()]
+
+    stream = [b"tag " + name.encode("utf-8"), b"from " + commit.encode("utf-8")]
+    for header in headers.split(b"\n"):
+        if header.startswith(b"tagger "):
+            stream.append(header)
+    stream.append(b"data %d" % len(message))
+    return b"\n".join(stream) + b"\n" + message + b"\n"
+
+
+def empty_commit_stream(repo, commit, ref, mark):
+    """Return the fast-import commands for an empty root commit standing in for commit
+
+    The new commit has the author, committer and message of commit but an
+    empty tree and no parents, so it carries none of the original history.
+    """
+    raw = repo.odb.stream(hex_to_bin(commit)).read()
+    headers, _, message = raw.partition(b"\n\n")
+
+    stream = [b"commit " + ref.encode("utf-8"), b"mark :%d" % mark]
+    for header in headers.split(b"\n"):
+        if header.startswith(b"author ") or header.startswith(b"committer "):
+            stream.append(header)
+    stream.append(b"data %d" % len(message))
+    return b"\n".join(stream) + b"\n" + message + b"\n"
+
+
+def rewrite_tags(repo, state_branch, tag_refs, empty_tags='drop', logger=None):
+    """Move all tags onto the rewritten history and drop the rewrite refs
+
+    Annotated tags are recreated with a single fast-import run, pointing at
+    the rewritten commit, which filter-branch maps to the nearest surviving
+    ancestor for skipped commits. Tags of tags are recreated directly on
+    the rewritten commit, as the tags they point to hold the old one. Tags
+    whose history became empty are handled according to empty_tags: 'drop'
+    deletes them, 'keep' moves them onto an empty root commit with the
+    original commit's message, so no unfiltered history is kept, and 'fail'
+    raises EmptyTagError. Lightweight tag updates, deletions and the
+    removal of refs/original/*, the refs created by prepare_tags and the
+    state branch are applied in one update-ref transaction.
+    """
+    if not logger:
+        logger = logging.getLogger()
+
+    tags = list_tags(repo)
+    commit_map = read_commit_map(repo, state_branch, set(commit for _, _, commit in tags))
+
+    empty = [ref for ref, _, commit in tags if commit_map.get(commit) == ""]
+    if empty and empty_tags == 'fail':
+        raise EmptyTagError("Tags with no remaining history: %s" % ", ".join(empty))
+
+    empty_marks = {}
+    empty_commits = []
+    fast_import = []
+    ref_updates = []
+    for ref, tag, commit in tags:
+        if commit not in commit_map:
+            logger.info("Leaving %s, %s was not rewritten" % (ref, commit))
+            continue
+
+        new_commit = commit_map[commit]
+        if new_commit == "":
+            if empty_tags == 'drop':
+                logger.info("Dropping %s, no history left" % ref)
+                ref_updates.append("delete %s" % ref)
+                continue
+
+            # fast-import creates the stand-in and the tag in the same run
+            if commit not in empty_marks:
+                empty_marks[commit] = len(empty_marks) + 1
+                empty_commits.append(empty_commit_stream(
+                    repo, commit, "%sempty/%s" % (tag_refs, commit), empty_marks[commit]))
+            new_commit = ":%d" % empty_marks[commit]
+            logger.info("Keeping %s on an empty commit in place of %s" % (ref, commit))
+            if tag is not None:
+                fast_import.append(tag_stream(repo, tag, ref[len("refs/tags/"):], new_commit))
+            else:
+                fast_import.append(("reset %s\nfrom %s\n\n" % (ref, new_commit)).encode("utf-8"))
+        elif tag is not None:
+            logger.info("Rewriting %s: %s -> %s" % (ref, commit, new_commit))
+            fast_import.append(tag_stream(repo, tag, ref[len("refs/tags/"):], new_commit))
+        else:
+            logger.info("Rewriting %s: %s -> %s" % (ref, commit, new_commit))
+            ref_updates.append("update %s %s" % (ref, new_commit))
+
+    if fast_import:
+        with tempfile.TemporaryFile() as stream:
+            stream.write(b"".join(empty_commits + fast_import))
+            stream.seek(0)
+            repo.git.fast_import("--force", "--quiet", istream=stream)
+
+    for ref in repo.git.for_each_ref("--format=%(refname)", "refs/original/", tag_refs).split():
+        logger.info("Deleting %s" % ref)
+        ref_updates.append("delete %s" % ref)
+    ref_updates.append("delete %s" % state_branch)
+
+    update_refs(repo, ref_updates)
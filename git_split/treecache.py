@@ -0,0 +1,216 @@
+# treecache
+#
+# module to keep a persistent cache of filtered top level entries next to
+# the source repository so that re-running a split, or running splits whose
+# include patterns overlap, can skip the index filtering for any entry that
+# has already been seen.
+#
+# Copyright 2020 Hewlett Packard Enterprise Development LP
+#
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shlex
+import tempfile
+
+import git
+
+from git_split import scratch
+
+
+class TreeCache:
+    """On-disk cache of top level entry -> filtered entry
+
+    The cache is a bare repository holding the filtered tree objects, with
+    an alternate pointing at the source repository for the blobs. Entries
+    are stored under 'map/<pattern-key>/<xx>/<object-sha>/<mode>/<name>'
+    where the pattern key combines the ids of the include patterns that
+    could match below that name, see pattern_table(). The first line of an entry is the
+    filtered 'mode type sha', or '-' when nothing is left, and any following
+    lines are the 'rm' output recorded when the entry was first filtered, so
+    the removed files report stays complete on cache hits.
+
+    Every split holds a shared lock on the cache for as long as it may read
+    from or write to it. Entries are written atomically by the index filter,
+    so concurrent splits only need to be kept away from eviction, which
+    requires the exclusive lock and is skipped when any other split is
+    still running.
+    """
+
+    version = 3
+    metachars = '.[]*^$\\"`'
+
+    def __init__(self, path, max_size, src_objects, logger=None):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.src_objects = os.path.abspath(src_objects)
+        self.objects = os.path.join(self.path, 'objects')
+        self.lockfile = os.path.join(self.path, 'lock')
+        self.initlockfile = os.path.join(self.path, 'init.lock')
+        self.logger = logger or logging.getLogger()
+        self._lock = None
+
+    @staticmethod
+    def pattern_id(content):
+        return int(hashlib.sha1(content.encode("utf-8")).hexdigest()[:15], 16)
+
+    @classmethod
+    def literal_prefix(cls, pattern):
+        """Return the part of a grep pattern that only matches itself"""
+        for i, char in enumerate(pattern):
+            if char in cls.metachars:
+                # '*' and '\{' make the previous character optional
+                return pattern[:max(i - 1, 0)] if char in '*\\' else pattern[:i]
+        return pattern
+
+    @classmethod
+    def pattern_table(cls, includes):
+        """Return the key base, literal prefixes and ids of the include patterns
+
+        The index filter xors the base with the id of every pattern whose
+        literal prefix could match below a top level name, giving a key
+        that only changes when a pattern relevant to that name changes.
+        """
+        normalized = sorted(set(pattern.strip() for pattern in includes if pattern.strip()))
+        return (cls.pattern_id("v%d" % cls.version),
+                [cls.literal_prefix(pattern) for pattern in normalized],
+                [cls.pattern_id(pattern) for pattern in normalized])
+
+    def index_filter(self, template, includes, clone_objects, include_args):
+        """Fill in FilterBranch.cached_index_filter for the given includes"""
+        base, prefixes, ids = self.pattern_table(includes)
+        return template % (
+            os.path.join(self.path, 'map'), self.objects, clone_objects, base,
+            " ".join(shlex.quote(prefix) for prefix in prefixes),
+            " ".join("%d" % pattern_id for pattern_id in ids),
+            include_args)
+
+    def open(self):
+        """Create the cache if needed and take the shared lock"""
+        os.makedirs(self.path, exist_ok=True)
+
+        # creation has its own lock, so it never waits on running splits
+        with open(self.initlockfile, 'a') as initlock:
+            fcntl.flock(initlock, fcntl.LOCK_EX)
+            if not os.path.isdir(self.objects):
+                self.logger.info("Creating tree cache at %s" % self.path)
+                git.Repo.init(self.path, bare=True)
+            alternates = os.path.join(self.objects, 'info', 'alternates')
+            if not os.path.exists(alternates):
+                with open(alternates, 'w') as f:
+                    f.write("%s\n" % self.src_objects)
+
+        self._lock = open(self.lockfile, 'a')
+        fcntl.flock(self._lock, fcntl.LOCK_SH)
+
+    def close(self):
+        """Evict old entries if no other split is using the cache"""
+        if self._lock is None:
+            return
+
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            self.logger.info("Tree cache in use by another split, skipping eviction")
+        else:
+            try:
+                self.evict()
+            except git.exc.GitCommandError as e:
+                self.logger.warning("Tree cache eviction failed: %s" % e)
+        finally:
+            self._lock.close()
+            self._lock = None
+
+    def attach(self, repo):
+        """Make the cached trees visible to the given repository"""
+        alternates = os.path.join(repo.git_dir, 'objects', 'info', 'alternates')
+        with open(alternates, 'a') as f:
+            f.write("%s\n" % self.objects)
+
+    def detach(self, repo):
+        """Copy any objects borrowed from the cache and drop the alternate"""
+        repo.git.repack("-a", "-d")
+
+        alternates = os.path.join(repo.git_dir, 'objects', 'info', 'alternates')
+        with open(alternates, 'r') as f:
+            paths = [line.strip() for line in f if line.strip() and line.strip() != self.objects]
+        if paths:
+            with open(alternates, 'w') as f:
+                f.write("".join("%s\n" % path for path in paths))
+        else:
+            os.unlink(alternates)
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(os.path.join(self.path, 'map')):
+            for name in files:
+                entry = os.path.join(root, name)
+                try:
+                    st = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry))
+        return entries
+
+    def disk_usage(self):
+        return scratch.disk_usage(self.objects, os.path.join(self.path, 'map'))
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits max_size
+
+        Must be called with the exclusive lock held. The surviving trees are
+        repacked into a single pack and every other pack and loose object is
+        removed, which releases the space used by the evicted trees.
+        """
+        size = self.disk_usage()
+        if size <= self.max_size:
+            return
+
+        entries = sorted(self._entries())
+        target = self.max_size * 3 // 4
+        drop = len(entries) - len(entries) * target // size
+        self.logger.info("Tree cache is %d bytes, evicting %d of %d entries" % (size, drop, len(entries)))
+
+        for _, _, entry in entries[:drop]:
+            os.unlink(entry)
+
+        trees = set()
+        for _, _, entry in entries[drop:]:
+            with open(entry, 'r') as f:
+                result = f.readline().split()
+            if len(result) == 3 and result[1] == 'tree':
+                trees.add(result[2])
+
+        pack_dir = os.path.join(self.objects, 'pack')
+        old_packs = [name for name in os.listdir(pack_dir) if name.startswith('pack-')]
+
+        cache_repo = git.Repo(self.path)
+        new_pack = None
+        if trees:
+            with tempfile.TemporaryFile() as tips, tempfile.TemporaryFile() as objects:
+                tips.write("".join("%s\n" % tree for tree in trees).encode("utf-8"))
+                tips.seek(0)
+                objects.write(cache_repo.git.rev_list(
+                    "--objects", "--no-object-names", "--filter=blob:none", "--stdin",
+                    istream=tips, stdout_as_string=False))
+                objects.seek(0)
+                new_pack = cache_repo.git.pack_objects(
+                    "--local", "-q", os.path.join(pack_dir, 'pack'), istream=objects).strip()
+
+        for name in old_packs:
+            if new_pack and new_pack in name:
+                continue
+            os.unlink(os.path.join(pack_dir, name))
+
+        for name in os.listdir(self.objects):
+            if re.match("^[0-9a-f]{2}$", name):
+                loose = os.path.join(self.objects, name)
+                for obj in os.listdir(loose):
+                    os.unlink(os.path.join(loose, obj))
+                os.rmdir(loose)